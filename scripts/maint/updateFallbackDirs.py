@@ -21,11 +21,9 @@
 # https://trac.torproject.org/projects/tor/attachment/ticket/8374/dir_list.2.py
 # Modifications by teor, 2015
 
-import StringIO
 import string
 import re
 import datetime
-import gzip
 import os.path
 import json
 import math
@@ -33,10 +31,13 @@ import sys
 import urllib
 import urllib2
 import hashlib
+import zlib
 import dateutil.parser
 # bson_lazy provides bson
 #from bson import json_util
-import copy
+import threading
+from collections import Counter
+from multiprocessing.pool import ThreadPool
 
 from stem.descriptor.remote import DescriptorDownloader
 
@@ -62,6 +63,14 @@ except ImportError:
                   ' A fallback list will be created, but optional netblock' +
                   ' analysis will not be performed.')
 
+try:
+  # ujson parses the large onionoo documents much faster than json
+  # it returns the same types as json, including unicode strings
+  import ujson as json_parser
+except ImportError:
+  # if this happens, we parse the onionoo documents using json
+  json_parser = json
+
 ## Top-Level Configuration
 
 # Output all candidate fallbacks, or only output selected fallbacks?
@@ -97,6 +106,12 @@ ONIONOO = 'https://onionoo.torproject.org/'
 # even if they're very old
 LOCAL_FILES_ONLY = False
 
+# Use the local files without asking OnionOO whether they have been modified,
+# as long as they were last modified in the past day
+# This saves time when re-running the script, but the relay flags and
+# addresses may be up to a day old
+REUSE_RECENT_LOCAL_FILES = False
+
 ## Whitelist / Blacklist Filter Settings
 
 # The whitelist contains entries that are included if all attributes match
@@ -132,6 +147,7 @@ MAX_LIST_FILE_SIZE = 1024 * 1024
 # This issue will be fixed in 0.2.7.7 and 0.2.8.2
 # Until then, the CUTOFFs below ensure a decent level of stability.
 ADDRESS_AND_PORT_STABLE_DAYS = 7
+ADDRESS_AND_PORT_STABLE_SECONDS = ADDRESS_AND_PORT_STABLE_DAYS * 24 * 3600
 # What time-weighted-fraction of these flags must FallbackDirs
 # Equal or Exceed?
 CUTOFF_RUNNING = .95
@@ -187,6 +203,16 @@ CONSENSUS_DOWNLOAD_SPEED_MAX = 15.0
 # If the relay fails a consensus check, retry the download
 # This avoids delisting a relay due to transient network conditions
 CONSENSUS_DOWNLOAD_RETRY = True
+# Check this many fallbacks' consensus downloads at the same time
+# Each check times the download and stem's validation of the consensus.
+# Concurrent checks share your network connection, and validation competes
+# for python's global interpreter lock, so checking more than one fallback at
+# a time can make healthy fallbacks too slow, and exclude them.
+# Only increase this if you can verify the results on a fast connection.
+# When it's more than 1, the last 'Initiating consensus download' line no
+# longer identifies the fallback that hung python. Use DEBUG logging, and
+# look for the download without a 'Consensus download:' result line.
+CONSENSUS_DOWNLOAD_THREADS = 1
 
 ## Fallback Weights for Client Selection
 
@@ -205,69 +231,104 @@ FALLBACK_OUTPUT_WEIGHT = 10.0
 
 ## Parsing Functions
 
+# the same timestamps appear in many relays' uptime histories, so we cache
+# the parsed datetimes (which are immutable)
+# there are only a few thousand distinct timestamps in an OnionOO document
+_parse_ts_cache = {}
+
 def parse_ts(t):
-  return datetime.datetime.strptime(t, "%Y-%m-%d %H:%M:%S")
-
-def remove_bad_chars(raw_string, bad_char_list):
-  # Remove each character in the bad_char_list
-  cleansed_string = raw_string
-  for c in bad_char_list:
-    cleansed_string = cleansed_string.replace(c, '')
-  return cleansed_string
-
-def cleanse_unprintable(raw_string):
-  # Remove all unprintable characters
-  cleansed_string = ''
-  for c in raw_string:
-    if c in string.printable:
-      cleansed_string += c
-  return cleansed_string
-
-def cleanse_whitespace(raw_string):
-  # Replace all whitespace characters with a space
-  cleansed_string = raw_string
-  for c in string.whitespace:
-    cleansed_string = cleansed_string.replace(c, ' ')
-  return cleansed_string
+  ts = _parse_ts_cache.get(t)
+  if ts is None:
+    # OnionOO always uses "%Y-%m-%d %H:%M:%S", so we slice out each field
+    # rather than using strptime(), which interprets the format every call
+    assert len(t) == 19 and t[4] == '-' and t[10] == ' ', t
+    ts = datetime.datetime(int(t[0:4]), int(t[5:7]), int(t[8:10]),
+                           int(t[11:13]), int(t[14:16]), int(t[17:19]))
+    _parse_ts_cache[t] = ts
+  return ts
+
+# The cleanse functions use translate(), so each string is filtered in a
+# single pass, rather than character-by-character in python.
+# str.translate() takes a 256-character table and the characters to delete,
+# unicode.translate() takes a dictionary keyed by code point.
+
+# the characters the C cleansing functions keep
+_PRINTABLE_CHARS = frozenset(string.printable)
+
+# every str character that isn't printable
+_UNPRINTABLE_CHARS = ''.join([chr(b) for b in range(256)
+                              if chr(b) not in _PRINTABLE_CHARS])
+
+class _UnicodePrintableTable(dict):
+  # there are too many unprintable code points to list them all, so we map
+  # printable characters to themselves, and delete everything else on lookup
+  def __missing__(self, code_point):
+    return None
+
+_UNICODE_PRINTABLE_TABLE = _UnicodePrintableTable(
+                                  (ord(c), ord(c)) for c in _PRINTABLE_CHARS)
+
+_WHITESPACE_TO_SPACE_TABLE = string.maketrans(string.whitespace,
+                                              ' ' * len(string.whitespace))
+_UNICODE_WHITESPACE_TO_SPACE_TABLE = dict((ord(c), u' ')
+                                          for c in string.whitespace)
+
+# the C cleansing functions replace whitespace with spaces, remove
+# unprintable characters, and remove their bad characters in a single
+# translate() pass
+# the str deletions are applied to the original characters, which is safe,
+# because whitespace is printable, and is never a bad character
+def _c_cleanse_unicode_table(bad_char_list):
+  table = _UnicodePrintableTable(_UNICODE_PRINTABLE_TABLE)
+  table.update(_UNICODE_WHITESPACE_TO_SPACE_TABLE)
+  table.update((ord(c), None) for c in bad_char_list)
+  return table
+
+def _c_cleanse(raw_string, str_delete_chars, unicode_table):
+  if isinstance(raw_string, unicode):
+    return raw_string.translate(unicode_table)
+  return raw_string.translate(_WHITESPACE_TO_SPACE_TABLE, str_delete_chars)
+
+# Prevent a malicious / unanticipated string from breaking out
+# of a C-style multiline comment
+# This removes '/*' and '*/' and '//'
+_C_COMMENT_BAD_CHARS = '*/'
+# Prevent a malicious string from using C nulls
+_C_COMMENT_BAD_CHARS += '\0'
+_C_COMMENT_STR_DELETE_CHARS = _UNPRINTABLE_CHARS + _C_COMMENT_BAD_CHARS
+_C_COMMENT_UNICODE_TABLE = _c_cleanse_unicode_table(_C_COMMENT_BAD_CHARS)
 
 def cleanse_c_multiline_comment(raw_string):
-  cleansed_string = raw_string
   # Embedded newlines should be removed by tor/onionoo, but let's be paranoid
-  cleansed_string = cleanse_whitespace(cleansed_string)
   # ContactInfo and Version can be arbitrary binary data
-  cleansed_string = cleanse_unprintable(cleansed_string)
-  # Prevent a malicious / unanticipated string from breaking out
-  # of a C-style multiline comment
-  # This removes '/*' and '*/' and '//'
-  bad_char_list = '*/'
-  # Prevent a malicious string from using C nulls
-  bad_char_list += '\0'
   # Be safer by removing bad characters entirely
-  cleansed_string = remove_bad_chars(cleansed_string, bad_char_list)
   # Some compilers may further process the content of comments
   # There isn't much we can do to cover every possible case
   # But comment-based directives are typically only advisory
-  return cleansed_string
+  return _c_cleanse(raw_string,
+                    _C_COMMENT_STR_DELETE_CHARS,
+                    _C_COMMENT_UNICODE_TABLE)
+
+# Prevent a malicious address/fingerprint string from breaking out
+# of a C-style string
+_C_STRING_BAD_CHARS = '"'
+# Prevent a malicious string from using escapes
+_C_STRING_BAD_CHARS += '\\'
+# Prevent a malicious string from using C nulls
+_C_STRING_BAD_CHARS += '\0'
+_C_STRING_STR_DELETE_CHARS = _UNPRINTABLE_CHARS + _C_STRING_BAD_CHARS
+_C_STRING_UNICODE_TABLE = _c_cleanse_unicode_table(_C_STRING_BAD_CHARS)
 
 def cleanse_c_string(raw_string):
-  cleansed_string = raw_string
   # Embedded newlines should be removed by tor/onionoo, but let's be paranoid
-  cleansed_string = cleanse_whitespace(cleansed_string)
   # ContactInfo and Version can be arbitrary binary data
-  cleansed_string = cleanse_unprintable(cleansed_string)
-  # Prevent a malicious address/fingerprint string from breaking out
-  # of a C-style string
-  bad_char_list = '"'
-  # Prevent a malicious string from using escapes
-  bad_char_list += '\\'
-  # Prevent a malicious string from using C nulls
-  bad_char_list += '\0'
   # Be safer by removing bad characters entirely
-  cleansed_string = remove_bad_chars(cleansed_string, bad_char_list)
   # Some compilers may further process the content of strings
   # There isn't much we can do to cover every possible case
   # But this typically only results in changes to the string data
-  return cleansed_string
+  return _c_cleanse(raw_string,
+                    _C_STRING_STR_DELETE_CHARS,
+                    _C_STRING_UNICODE_TABLE)
 
 ## OnionOO Source Functions
 
@@ -288,20 +349,12 @@ def fetch_source_list():
 
 # given 'what', provide a multiline C comment describing the source
 def describe_fetch_source(what):
-  desc = '/*'
-  desc += '\n'
-  desc += 'Onionoo Source: '
-  desc += cleanse_c_multiline_comment(what)
-  desc += ' Date: '
-  desc += cleanse_c_multiline_comment(fetch_source[what]['relays_published'])
-  desc += ' Version: '
-  desc += cleanse_c_multiline_comment(fetch_source[what]['version'])
-  desc += '\n'
-  desc += 'URL: '
-  desc += cleanse_c_multiline_comment(fetch_source[what]['url'])
-  desc += '\n'
-  desc += '*/'
-  return desc
+  source = fetch_source[what]
+  return '/*\nOnionoo Source: %s Date: %s Version: %s\nURL: %s\n*/'%(
+            cleanse_c_multiline_comment(what),
+            cleanse_c_multiline_comment(source['relays_published']),
+            cleanse_c_multiline_comment(source['version']),
+            cleanse_c_multiline_comment(source['url']))
 
 ## File Processing Functions
 
@@ -329,20 +382,20 @@ def read_from_file(file_name, max_len):
                  )
   return None
 
-def load_possibly_compressed_response_json(response):
+def read_possibly_compressed_response(response):
     if response.info().get('Content-Encoding') == 'gzip':
-      buf = StringIO.StringIO( response.read() )
-      f = gzip.GzipFile(fileobj=buf)
-      return json.load(f)
+      # decompress in a single zlib call, rather than wrapping the response
+      # in file objects (16 + MAX_WBITS means "expect a gzip header")
+      return zlib.decompress(response.read(), 16 + zlib.MAX_WBITS)
     else:
-      return json.load(response)
+      return response.read()
 
 def load_json_from_file(json_file_name):
     # An exception here may be resolved by deleting the .last_modified
     # and .json files, and re-running the script
     try:
       with open(json_file_name, 'r') as f:
-        return json.load(f)
+        return json_parser.load(f)
     except EnvironmentError, error:
       raise Exception('Reading not-modified json file %s failed: %d: %s'%
                     (json_file_name,
@@ -392,14 +445,9 @@ def onionoo_fetch(what, **kwargs):
     # no need to compare as long as you trust SHA-1
     write_to_file(url, full_url_file_name, MAX_FULL_URL_LENGTH)
 
-    request = urllib2.Request(url)
-    request.add_header('Accept-encoding', 'gzip')
-
     # load the last modified date from the file, if it exists
     last_mod_date = read_from_file(last_modified_file_name,
                                    MAX_LAST_MODIFIED_LENGTH)
-    if last_mod_date is not None:
-      request.add_header('If-modified-since', last_mod_date)
 
     # Parse last modified date
     last_mod = datestr_to_datetime(last_mod_date)
@@ -411,53 +459,75 @@ def onionoo_fetch(what, **kwargs):
     required_freshness = required_freshness.replace(tzinfo=None)
     required_freshness -= datetime.timedelta(hours=24)
 
-    # Make the OnionOO request
-    response_code = 0
-    try:
-      response = urllib2.urlopen(request)
-      response_code = response.getcode()
-    except urllib2.HTTPError, error:
-      response_code = error.code
-      if response_code == 304: # not modified
-        pass
-      else:
-        raise Exception("Could not get " + url + ": "
-                        + str(error.code) + ": " + error.reason)
+    if (REUSE_RECENT_LOCAL_FILES and last_mod_date is not None
+        and last_mod >= required_freshness
+        and os.path.isfile(json_file_name)):
+      # Our copy is still recent enough to be useful, and we've been told
+      # not to ask OnionOO whether it has been modified
+      cache_age = datetime.datetime.utcnow() - last_mod
+      logging.warning('Using local %s document last modified %s ' +
+                      '(%.1f hours ago), without checking for a newer one.',
+                      what, last_mod_date,
+                      cache_age.total_seconds()/3600.0)
+      response_json = load_json_from_file(json_file_name)
+    else:
+      request = urllib2.Request(url)
+      request.add_header('Accept-encoding', 'gzip')
+      if last_mod_date is not None:
+        request.add_header('If-modified-since', last_mod_date)
+
+      # Make the OnionOO request
+      # urllib2 opens a new connection for each request. We make at most two
+      # onionoo requests per run, so reusing the connection would only save
+      # one TLS handshake, which isn't worth a dependency on requests/urllib3
+      response_code = 0
+      try:
+        response = urllib2.urlopen(request)
+        response_code = response.getcode()
+      except urllib2.HTTPError, error:
+        response_code = error.code
+        if response_code == 304: # not modified
+          pass
+        else:
+          raise Exception("Could not get " + url + ": "
+                          + str(error.code) + ": " + error.reason)
 
-    if response_code == 200: # OK
-      last_mod = datestr_to_datetime(response.info().get('Last-Modified'))
+      if response_code == 200: # OK
+        last_mod = datestr_to_datetime(response.info().get('Last-Modified'))
 
-    # Check for freshness
-    if last_mod < required_freshness:
-      if last_mod_date is not None:
-        # This check sometimes fails transiently, retry the script if it does
-        date_message = "Outdated data: last updated " + last_mod_date
-      else:
-        date_message = "No data: never downloaded "
-      raise Exception(date_message + " from " + url)
+      # Check for freshness
+      if last_mod < required_freshness:
+        if last_mod_date is not None:
+          # This check sometimes fails transiently, retry the script if it does
+          date_message = "Outdated data: last updated " + last_mod_date
+        else:
+          date_message = "No data: never downloaded "
+        raise Exception(date_message + " from " + url)
 
-    # Process the data
-    if response_code == 200: # OK
+      # Process the data
+      if response_code == 200: # OK
 
-      response_json = load_possibly_compressed_response_json(response)
+        response_data = read_possibly_compressed_response(response)
+        response_json = json_parser.loads(response_data)
 
-      with open(json_file_name, 'w') as f:
-        # use the most compact json representation to save space
-        json.dump(response_json, f, separators=(',',':'))
+        with open(json_file_name, 'w') as f:
+          # store the document as we received it, rather than re-encoding
+          # the parsed json (which takes about as long as parsing it)
+          f.write(response_data)
 
-      # store the last modified date in its own file
-      if response.info().get('Last-modified') is not None:
-        write_to_file(response.info().get('Last-Modified'),
-                      last_modified_file_name,
-                      MAX_LAST_MODIFIED_LENGTH)
+        # store the last modified date in its own file
+        if response.info().get('Last-modified') is not None:
+          write_to_file(response.info().get('Last-Modified'),
+                        last_modified_file_name,
+                        MAX_LAST_MODIFIED_LENGTH)
 
-    elif response_code == 304: # Not Modified
+      elif response_code == 304: # Not Modified
 
-      response_json = load_json_from_file(json_file_name)
+        response_json = load_json_from_file(json_file_name)
 
-    else: # Unexpected HTTP response code not covered in the HTTPError above
-      raise Exception("Unexpected HTTP response code to " + url + ": "
-                      + str(response_code))
+      else: # Unexpected HTTP response code not covered in the HTTPError above
+        raise Exception("Unexpected HTTP response code to " + url + ": "
+                        + str(response_code))
 
   register_fetch_source(what,
                         url,
@@ -476,7 +546,16 @@ def fetch(what, **kwargs):
 
 ## Fallback Candidate Class
 
+# each consensus download thread reuses its own DescriptorDownloader
+_downloader_local = threading.local()
+
 class Candidate(object):
+  # there are thousands of candidates, so we avoid a per-instance __dict__
+  # add any new instance attributes here
+  __slots__ = ('_data', '_fpr', '_running', '_guard', '_v2dir', '_badexit',
+               'dirip', 'dirport', 'orport', 'ipv6addr', 'ipv6orport',
+               '_has_ipv6', '_ipv6')
+
   CUTOFF_ADDRESS_AND_PORT_STABLE = (datetime.datetime.utcnow()
                             - datetime.timedelta(ADDRESS_AND_PORT_STABLE_DAYS))
 
@@ -489,6 +568,9 @@ class Candidate(object):
       details['contact'] = None
     if not 'flags' in details or details['flags'] is None:
       details['flags'] = []
+    # is_exit, is_guard, and is_running are checked for every candidate,
+    # so make them hashed lookups
+    details['flags'] = frozenset(details['flags'])
     if (not 'advertised_bandwidth' in details
         or details['advertised_bandwidth'] is None):
       # relays without advertised bandwdith have it calculated from their
@@ -509,8 +591,17 @@ class Candidate(object):
     if self.orport is None:
       raise Exception("Failed to get an orport for %s."%(self._fpr,))
     self._compute_ipv6addr()
-    if not self.has_ipv6():
-      logging.debug("Failed to get an ipv6 address for %s."%(self._fpr,))
+    # the IPv6 address and ORPort don't change after this, so has_ipv6()
+    # returns _has_ipv6, which is also used directly in the hot paths
+    self._has_ipv6 = (self.ipv6addr is not None
+                      and self.ipv6orport is not None)
+    # the whitelist and blacklist use the IPv6 address and ORPort together,
+    # so we calculate it once, rather than for every comparison
+    if self._has_ipv6:
+      self._ipv6 = '%s:%d'%(self.ipv6addr, self.ipv6orport)
+    else:
+      self._ipv6 = None
+      logging.debug("Failed to get an ipv6 address for %s.", self._fpr)
 
   def _stable_sort_or_addresses(self):
     # replace self._data['or_addresses'] with a stable ordering,
@@ -528,58 +619,48 @@ class Candidate(object):
     return self._fpr
 
   # is_valid_ipv[46]_address by gsathya, karsten, 2013
+  # rewritten as precompiled regular expressions, so each check is a single
+  # match
+
+  # four period separated decimal values between 0-255,
+  # without leading zeros (for instance, "1.2.3.001" is invalid)
+  _IPV4_OCTET = r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+  _IPV4_PATTERN = r'(?:%s\.){3}%s'%(_IPV4_OCTET, _IPV4_OCTET)
+  _IPV4_RE = re.compile(r'^%s\Z'%(_IPV4_PATTERN,))
+
+  # addresses are made up of eight colon separated groups of four hex digits
+  # with leading zeros being optional, and at most one group of zeros
+  # collapsed to "::". The last two groups may be an embedded IPv4 address.
+  # https://en.wikipedia.org/wiki/IPv6#Address_format
+  # This is the IPv6address grammar from RFC 3986, section 3.2.2
+  _IPV6_H16 = r'[0-9a-fA-F]{1,4}'
+  _IPV6_LS32 = r'(?:%s:%s|%s)'%(_IPV6_H16, _IPV6_H16, _IPV4_PATTERN)
+  _IPV6_RE = re.compile((r'^(?:'
+                         r'(?:%(h16)s:){6}%(ls32)s'
+                         r'|::(?:%(h16)s:){5}%(ls32)s'
+                         r'|(?:%(h16)s)?::(?:%(h16)s:){4}%(ls32)s'
+                         r'|(?:(?:%(h16)s:){0,1}%(h16)s)?::(?:%(h16)s:){3}'
+                         r'%(ls32)s'
+                         r'|(?:(?:%(h16)s:){0,2}%(h16)s)?::(?:%(h16)s:){2}'
+                         r'%(ls32)s'
+                         r'|(?:(?:%(h16)s:){0,3}%(h16)s)?::%(h16)s:%(ls32)s'
+                         r'|(?:(?:%(h16)s:){0,4}%(h16)s)?::%(ls32)s'
+                         r'|(?:(?:%(h16)s:){0,5}%(h16)s)?::%(h16)s'
+                         r'|(?:(?:%(h16)s:){0,6}%(h16)s)?::'
+                         r')\Z')%{ 'h16': _IPV6_H16, 'ls32': _IPV6_LS32 })
+
   @staticmethod
   def is_valid_ipv4_address(address):
     if not isinstance(address, (str, unicode)):
       return False
-
-    # check if there are four period separated values
-    if address.count(".") != 3:
-      return False
-
-    # checks that each value in the octet are decimal values between 0-255
-    for entry in address.split("."):
-      if not entry.isdigit() or int(entry) < 0 or int(entry) > 255:
-        return False
-      elif entry[0] == "0" and len(entry) > 1:
-        return False  # leading zeros, for instance in "1.2.3.001"
-
-    return True
+    return Candidate._IPV4_RE.match(address) is not None
 
   @staticmethod
   def is_valid_ipv6_address(address):
     if not isinstance(address, (str, unicode)):
       return False
-
     # remove brackets
-    address = address[1:-1]
-
-    # addresses are made up of eight colon separated groups of four hex digits
-    # with leading zeros being optional
-    # https://en.wikipedia.org/wiki/IPv6#Address_format
-
-    colon_count = address.count(":")
-
-    if colon_count > 7:
-      return False  # too many groups
-    elif colon_count != 7 and not "::" in address:
-      return False  # not enough groups and none are collapsed
-    elif address.count("::") > 1 or ":::" in address:
-      return False  # multiple groupings of zeros can't be collapsed
-
-    found_ipv4_on_previous_entry = False
-    for entry in address.split(":"):
-      # If an IPv6 address has an embedded IPv4 address,
-      # it must be the last entry
-      if found_ipv4_on_previous_entry:
-        return False
-      if not re.match("^[0-9a-fA-f]{0,4}$", entry):
-        if not Candidate.is_valid_ipv4_address(entry):
-          return False
-        else:
-          found_ipv4_on_previous_entry = True
-
-    return True
+    return Candidate._IPV6_RE.match(address[1:-1]) is not None
 
   def _split_dirport(self):
     # Split the dir_address into dirip and dirport
@@ -591,11 +672,13 @@ class Candidate(object):
     # In rare circumstances, this might not be the primary ORPort address.
     # However, _stable_sort_or_addresses() ensures we choose the same one
     # every time, even if onionoo changes the order of the secondaries.
-    self._split_dirport()
+    # Call _split_dirport() before calling this.
     self.orport = None
-    for i in self._data['or_addresses']:
-      if i != self._data['or_addresses'][0]:
-        logging.debug('Secondary IPv4 Address Used for %s: %s'%(self._fpr, i))
+    or_addresses = self._data['or_addresses']
+    or_address_primary = or_addresses[0]
+    for i in or_addresses:
+      if i != or_address_primary:
+        logging.debug('Secondary IPv4 Address Used for %s: %s', self._fpr, i)
       (ipaddr, port) = i.rsplit(':', 1)
       if (ipaddr == self.dirip) and Candidate.is_valid_ipv4_address(ipaddr):
         self.orport = int(port)
@@ -608,15 +691,16 @@ class Candidate(object):
     # every time, even if onionoo changes the order of the secondaries.
     self.ipv6addr = None
     self.ipv6orport = None
+    or_addresses = self._data['or_addresses']
     # Choose the first IPv6 address that uses the same port as the ORPort
-    for i in self._data['or_addresses']:
+    for i in or_addresses:
       (ipaddr, port) = i.rsplit(':', 1)
       if (port == self.orport) and Candidate.is_valid_ipv6_address(ipaddr):
         self.ipv6addr = ipaddr
         self.ipv6orport = int(port)
         return
     # Choose the first IPv6 address in the list
-    for i in self._data['or_addresses']:
+    for i in or_addresses:
       (ipaddr, port) = i.rsplit(':', 1)
       if Candidate.is_valid_ipv6_address(ipaddr):
         self.ipv6addr = ipaddr
@@ -676,31 +760,42 @@ class Candidate(object):
     newest = now
     for p in periods:
       h = history[p]
-      interval = datetime.timedelta(seconds = h['interval'])
+      # the interval is the same for every value in the period
+      interval_secs = h['interval']
+      interval = datetime.timedelta(seconds = interval_secs)
       this_ts = parse_ts(h['last'])
+      first_ts = parse_ts(h['first'])
 
       if (len(h['values']) != h['count']):
-        logging.warning('Inconsistent value count in %s document for %s'
-                        %(p, which))
-      for v in reversed(h['values']):
-        if (this_ts <= newest):
-          agt1 = now - this_ts
-          agt2 = interval
-          agetmp1 = (agt1.microseconds + (agt1.seconds + agt1.days * 24 * 3600)
-                     * 10**6) / 10**6
-          agetmp2 = (agt2.microseconds + (agt2.seconds + agt2.days * 24 * 3600)
-                     * 10**6) / 10**6
-          generic_history.append(
-            { 'age': agetmp1,
-              'length': agetmp2,
-              'value': v
-            })
-          newest = this_ts
+        logging.warning('Inconsistent value count in %s document for %s',
+                        p, which)
+      values = h['values']
+      # skip the newest values, if they overlap the shorter periods we've
+      # already used
+      used_count = len(values)
+      while used_count > 0 and this_ts > newest:
+        used_count -= 1
         this_ts -= interval
+      # the remaining values are contiguous, so each value is exactly one
+      # interval older than the next, and we can calculate the ages directly
+      # ages are whole seconds, so that _avg_generic_history weights them by
+      # whole days
+      if used_count > 0:
+        newest_age_delta = now - this_ts
+        newest_age = (newest_age_delta.days * 24 * 3600
+                      + newest_age_delta.seconds)
+        generic_history.extend([
+            { 'age': newest_age + i * interval_secs,
+              'length': interval_secs,
+              'value': v
+            }
+            for (i, v) in enumerate(reversed(values[:used_count]))])
+        this_ts -= interval * used_count
+        newest = this_ts + interval
 
-      if (this_ts + interval != parse_ts(h['first'])):
-        logging.warning('Inconsistent time information in %s document for %s'
-                        %(p, which))
+      if (this_ts + interval != first_ts):
+        logging.warning('Inconsistent time information in %s document for %s',
+                        p, which)
 
     #print json.dumps(generic_history, sort_keys=True,
     #                  indent=4, separators=(',', ': '))
@@ -708,18 +803,23 @@ class Candidate(object):
 
   @staticmethod
   def _avg_generic_history(generic_history):
-    a = []
+    # accumulate the weighted sums in a single pass
+    # the weights are all positive, so we don't need math.fsum()
+    # AGE_ALPHA^days is calculated as exp(log(AGE_ALPHA)*days)
+    log_alpha = math.log(AGE_ALPHA)
+    sv = 0.0
+    sw = 0.0
     for i in generic_history:
-      if i['age'] > (ADDRESS_AND_PORT_STABLE_DAYS * 24 * 3600):
+      age = i['age']
+      if age is None or age > ADDRESS_AND_PORT_STABLE_SECONDS:
         continue
-      if (i['length'] is not None
-          and i['age'] is not None
-          and i['value'] is not None):
-        w = i['length'] * math.pow(AGE_ALPHA, i['age']/(3600*24))
-        a.append( (i['value'] * w, w) )
-
-    sv = math.fsum(map(lambda x: x[0], a))
-    sw = math.fsum(map(lambda x: x[1], a))
+      length = i['length']
+      value = i['value']
+      if length is not None and value is not None:
+        # the weight decays once per whole day of age
+        w = length * math.exp(log_alpha * (age//(3600*24)))
+        sv += value * w
+        sw += w
 
     if sw == 0.0:
       svw = 0.0
@@ -728,8 +828,8 @@ class Candidate(object):
     return svw
 
   def _add_generic_history(self, history):
-    periods = r['read_history'].keys()
-    periods.sort(key = lambda x: r['read_history'][x]['interval'] )
+    periods = history.keys()
+    periods.sort(key = lambda x: history[x]['interval'])
 
     print periods
 
@@ -737,16 +837,16 @@ class Candidate(object):
     pass
 
   def add_uptime(self, uptime):
-    logging.debug('Adding uptime %s.'%(self._fpr,))
+    logging.debug('Adding uptime %s.', self._fpr)
 
     # flags we care about: Running, V2Dir, Guard
     if not 'flags' in uptime:
-      logging.debug('No flags in document for %s.'%(self._fpr,))
+      logging.debug('No flags in document for %s.', self._fpr)
       return
 
     for f in ['Running', 'Guard', 'V2Dir']:
       if not f in uptime['flags']:
-        logging.debug('No %s in flags for %s.'%(f, self._fpr,))
+        logging.debug('No %s in flags for %s.', f, self._fpr)
         return
 
     running = self._extract_generic_history(uptime['flags']['Running'],
@@ -766,17 +866,26 @@ class Candidate(object):
     if 'BadExit' in uptime['flags']:
       self._badexit = self._avg_generic_history(badexit) / ONIONOO_SCALE_ONE
 
+  # the cheapest and most selective checks are performed first
   def is_candidate(self):
+    d = self._data
+    if d.get('consensus_weight', 0) < 1:
+      logging.info('%s not a candidate: consensus weight invalid', self._fpr)
+      return False
+    # if the relay doesn't report a version, also exclude the relay
+    if not d.get('recommended_version'):
+      logging.info('%s not a candidate: version not recommended', self._fpr)
+      return False
     must_be_running_now = (PERFORM_IPV4_DIRPORT_CHECKS
                            or PERFORM_IPV6_DIRPORT_CHECKS)
     if (must_be_running_now and not self.is_running()):
       logging.info('%s not a candidate: not running now, unable to check ' +
                    'DirPort consensus download', self._fpr)
       return False
-    if (self._data['last_changed_address_or_port'] >
-        self.CUTOFF_ADDRESS_AND_PORT_STABLE):
+    last_changed = d['last_changed_address_or_port']
+    if last_changed > self.CUTOFF_ADDRESS_AND_PORT_STABLE:
       logging.info('%s not a candidate: changed address/port recently (%s)',
-                   self._fpr, self._data['last_changed_address_or_port'])
+                   self._fpr, last_changed)
       return False
     if self._running < CUTOFF_RUNNING:
       logging.info('%s not a candidate: running avg too low (%lf)',
@@ -790,22 +899,13 @@ class Candidate(object):
       logging.info('%s not a candidate: badexit avg too high (%lf)',
                    self._fpr, self._badexit)
       return False
-    # if the relay doesn't report a version, also exclude the relay
-    if (not self._data.has_key('recommended_version')
-        or not self._data['recommended_version']):
-      logging.info('%s not a candidate: version not recommended', self._fpr)
-      return False
     if self._guard < CUTOFF_GUARD:
       logging.info('%s not a candidate: guard avg too low (%lf)',
                    self._fpr, self._guard)
       return False
-    if (not self._data.has_key('consensus_weight')
-        or self._data['consensus_weight'] < 1):
-      logging.info('%s not a candidate: consensus weight invalid', self._fpr)
-      return False
     return True
 
-  def is_in_whitelist(self, relaylist):
+  def is_in_whitelist(self, relaylist_index):
     """ A fallback matches if each key in the whitelist line matches:
           ipv4
           dirport
@@ -813,22 +913,30 @@ class Candidate(object):
           id
           ipv6 address and port (if present)
         If the fallback has an ipv6 key, the whitelist line must also have
-        it, and vice versa, otherwise they don't match. """
-    ipv6 = None
-    if self.has_ipv6():
-      ipv6 = '%s:%d'%(self.ipv6addr, self.ipv6orport)
-    for entry in relaylist:
-      if entry['id'] != self._fpr:
-        # can't log here unless we match an IP and port, because every relay's
-        # fingerprint is compared to every entry's fingerprint
-        if entry['ipv4'] == self.dirip and int(entry['orport']) == self.orport:
-          logging.warning('%s excluded: has OR %s:%d changed fingerprint to ' +
-                          '%s?', entry['id'], self.dirip, self.orport,
-                          self._fpr)
-        if self.has_ipv6() and entry.has_key('ipv6') and entry['ipv6'] == ipv6:
+        it, and vice versa, otherwise they don't match.
+        relaylist_index is the whitelist, indexed by
+        CandidateList.index_relaylist(), so we only look at the entries that
+        share this fallback's id, IPv4, or IPv6. """
+    ipv6 = self._ipv6
+    # most fallbacks don't share any values with the whitelist, and there's
+    # nothing to log for them
+    any_values = relaylist_index['any']
+    if (self._fpr not in any_values and self.dirip not in any_values
+        and ipv6 not in any_values):
+      return False
+    # we only log entries with other fingerprints when they match an IP and
+    # port, otherwise every relay would be logged against every entry
+    for entry in relaylist_index['ipv4'].get(self.dirip, []):
+      if entry['id'] != self._fpr and int(entry['orport']) == self.orport:
+        logging.warning('%s excluded: has OR %s:%d changed fingerprint to ' +
+                        '%s?', entry['id'], self.dirip, self.orport,
+                        self._fpr)
+    if self._has_ipv6:
+      for entry in relaylist_index['ipv6'].get(ipv6, []):
+        if entry['id'] != self._fpr:
           logging.warning('%s excluded: has OR %s changed fingerprint to ' +
                           '%s?', entry['id'], ipv6, self._fpr)
-        continue
+    for entry in relaylist_index['id'].get(self._fpr, []):
       if entry['ipv4'] != self.dirip:
         logging.warning('%s excluded: has it changed IPv4 from %s to %s?',
                         self._fpr, entry['ipv4'], self.dirip)
@@ -843,7 +951,7 @@ class Candidate(object):
                         '%s:%d?', self._fpr, self.dirip, int(entry['orport']),
                         self.dirip, self.orport)
         continue
-      if entry.has_key('ipv6') and self.has_ipv6():
+      if 'ipv6' in entry and self._has_ipv6:
         # if both entry and fallback have an ipv6 address, compare them
         if entry['ipv6'] != ipv6:
           logging.warning('%s excluded: has it changed IPv6 ORPort from %s ' +
@@ -851,18 +959,18 @@ class Candidate(object):
           continue
       # if the fallback has an IPv6 address but the whitelist entry
       # doesn't, or vice versa, the whitelist entry doesn't match
-      elif entry.has_key('ipv6') and not self.has_ipv6():
+      elif 'ipv6' in entry and not self._has_ipv6:
         logging.warning('%s excluded: has it lost its former IPv6 address %s?',
                         self._fpr, entry['ipv6'])
         continue
-      elif not entry.has_key('ipv6') and self.has_ipv6():
+      elif 'ipv6' not in entry and self._has_ipv6:
         logging.warning('%s excluded: has it gained an IPv6 address %s?',
                         self._fpr, ipv6)
         continue
       return True
     return False
 
-  def is_in_blacklist(self, relaylist):
+  def is_in_blacklist(self, relaylist_index):
     """ A fallback matches a blacklist line if a sufficiently specific group
         of attributes matches:
           ipv4 & dirport
@@ -873,65 +981,70 @@ class Candidate(object):
         If the fallback and the blacklist line both have an ipv6 key,
         their values will be compared, otherwise, they will be ignored.
         If there is no dirport and no orport, the entry matches all relays on
-        that ip. """
-    for entry in relaylist:
-      for key in entry:
-        value = entry[key]
-        if key == 'id' and value == self._fpr:
-          logging.info('%s is in the blacklist: fingerprint matches',
-                       self._fpr)
+        that ip.
+        relaylist_index is the blacklist, indexed by
+        CandidateList.index_relaylist(), so we only look at the entries that
+        share this fallback's id, IPv4, or IPv6. """
+    ipv6 = self._ipv6
+    # most fallbacks don't share any values with the blacklist
+    any_values = relaylist_index['any']
+    if (self._fpr not in any_values and self.dirip not in any_values
+        and ipv6 not in any_values):
+      return False
+    for entry in relaylist_index['id'].get(self._fpr, []):
+      # if both entry and fallback have an ipv6 address, it's compared below,
+      # otherwise, disregard ipv6 addresses
+      # only log if the fingerprint matches but the IPv6 doesn't
+      if ('ipv6' in entry) != self._has_ipv6:
+        # don't build the address strings unless we're going to log them
+        if logging.getLogger().isEnabledFor(logging.INFO):
+          logging.info('%s skipping IPv6 blacklist comparison: relay ' +
+                       'has%s IPv6%s, but entry has%s IPv6%s', self._fpr,
+                       '' if self._has_ipv6 else ' no',
+                       (' (' + ipv6 + ')') if self._has_ipv6 else  '',
+                       '' if 'ipv6' in entry else ' no',
+                       (' (' + entry['ipv6'] + ')') if 'ipv6' in entry
+                       else '')
+        logging.warning('Has %s %s IPv6 address %s?', self._fpr,
+                    'gained an' if self._has_ipv6 else 'lost its former',
+                    ipv6 if self._has_ipv6 else entry['ipv6'])
+      logging.info('%s is in the blacklist: fingerprint matches',
+                   self._fpr)
+      return True
+    for entry in relaylist_index['ipv4'].get(self.dirip, []):
+      # if the dirport is present, check it too
+      if 'dirport' in entry:
+        if int(entry['dirport']) == self.dirport:
+          logging.info('%s is in the blacklist: IPv4 (%s) and ' +
+                       'DirPort (%d) match', self._fpr, self.dirip,
+                       self.dirport)
           return True
-        if key == 'ipv4' and value == self.dirip:
-          # if the dirport is present, check it too
-          if entry.has_key('dirport'):
-            if int(entry['dirport']) == self.dirport:
-              logging.info('%s is in the blacklist: IPv4 (%s) and ' +
-                           'DirPort (%d) match', self._fpr, self.dirip,
-                           self.dirport)
-              return True
-          # if the orport is present, check it too
-          elif entry.has_key('orport'):
-            if int(entry['orport']) == self.orport:
-              logging.info('%s is in the blacklist: IPv4 (%s) and ' +
-                           'ORPort (%d) match', self._fpr, self.dirip,
-                           self.orport)
-              return True
-          else:
-            logging.info('%s is in the blacklist: IPv4 (%s) matches, and ' +
-                         'entry has no DirPort or ORPort', self._fpr,
-                         self.dirip)
+      # if the orport is present, check it too
+      elif 'orport' in entry:
+        if int(entry['orport']) == self.orport:
+          logging.info('%s is in the blacklist: IPv4 (%s) and ' +
+                       'ORPort (%d) match', self._fpr, self.dirip,
+                       self.orport)
+          return True
+      else:
+        logging.info('%s is in the blacklist: IPv4 (%s) matches, and ' +
+                     'entry has no DirPort or ORPort', self._fpr,
+                     self.dirip)
+        return True
+    if self._has_ipv6:
+      for entry in relaylist_index['ipv6'].get(ipv6, []):
+        # if the dirport is present, check it too
+        if 'dirport' in entry:
+          if int(entry['dirport']) == self.dirport:
+            logging.info('%s is in the blacklist: IPv6 (%s) and ' +
+                         'DirPort (%d) match', self._fpr, ipv6,
+                         self.dirport)
             return True
-        ipv6 = None
-        if self.has_ipv6():
-          ipv6 = '%s:%d'%(self.ipv6addr, self.ipv6orport)
-        if (key == 'ipv6' and self.has_ipv6()):
-        # if both entry and fallback have an ipv6 address, compare them,
-        # otherwise, disregard ipv6 addresses
-          if value == ipv6:
-            # if the dirport is present, check it too
-            if entry.has_key('dirport'):
-              if int(entry['dirport']) == self.dirport:
-                logging.info('%s is in the blacklist: IPv6 (%s) and ' +
-                             'DirPort (%d) match', self._fpr, ipv6,
-                             self.dirport)
-                return True
-            # we've already checked the ORPort, it's part of entry['ipv6']
-            else:
-              logging.info('%s is in the blacklist: IPv6 (%s) matches, and' +
-                           'entry has no DirPort', self._fpr, ipv6)
-              return True
-        elif (key == 'ipv6' or self.has_ipv6()):
-          # only log if the fingerprint matches but the IPv6 doesn't
-          if entry.has_key('id') and entry['id'] == self._fpr:
-            logging.info('%s skipping IPv6 blacklist comparison: relay ' +
-                         'has%s IPv6%s, but entry has%s IPv6%s', self._fpr,
-                         '' if self.has_ipv6() else ' no',
-                         (' (' + ipv6 + ')') if self.has_ipv6() else  '',
-                         '' if key == 'ipv6' else ' no',
-                         (' (' + value + ')') if key == 'ipv6' else '')
-            logging.warning('Has %s %s IPv6 address %s?', self._fpr,
-                        'gained an' if self.has_ipv6() else 'lost its former',
-                        ipv6 if self.has_ipv6() else value)
+        # we've already checked the ORPort, it's part of entry['ipv6']
+        else:
+          logging.info('%s is in the blacklist: IPv6 (%s) matches, and' +
+                       'entry has no DirPort', self._fpr, ipv6)
+          return True
     return False
 
   def cw_to_bw_factor(self):
@@ -968,8 +1081,9 @@ class Candidate(object):
     return 'Running' in self._data['flags']
 
   # does this fallback have an IPv6 address and orport?
+  # calculated once in __init__
   def has_ipv6(self):
-    return self.ipv6addr is not None and self.ipv6orport is not None
+    return self._has_ipv6
 
   # strip leading and trailing brackets from an IPv6 address
   # safe to use on non-bracketed IPv6 and on IPv4 addresses
@@ -1066,7 +1180,10 @@ class Candidate(object):
   @staticmethod
   def fallback_consensus_download_speed(dirip, dirport, nickname, max_time):
     download_failed = False
-    downloader = DescriptorDownloader()
+    downloader = getattr(_downloader_local, 'downloader', None)
+    if downloader is None:
+      downloader = DescriptorDownloader()
+      _downloader_local.downloader = downloader
     start = datetime.datetime.utcnow()
     # some directory mirrors respond to requests in ways that hang python
     # sockets, which is why we log this line here
@@ -1110,8 +1227,9 @@ class Candidate(object):
                                                 self.dirport,
                                                 self._data['nickname'],
                                                 CONSENSUS_DOWNLOAD_SPEED_MAX)
-    if self.has_ipv6() and PERFORM_IPV6_DIRPORT_CHECKS:
+    if self._has_ipv6 and PERFORM_IPV6_DIRPORT_CHECKS:
       # Clients assume the IPv6 DirPort is the same as the IPv4 DirPort
+      # Check it after IPv4, so the downloads don't affect each other's timing
       ipv6_failed = Candidate.fallback_consensus_download_speed(self.ipv6addr,
                                                 self.dirport,
                                                 self._data['nickname'],
@@ -1130,16 +1248,19 @@ class Candidate(object):
     if not PERFORM_IPV4_DIRPORT_CHECKS and not PERFORM_IPV6_DIRPORT_CHECKS:
       return True
     # if we are performing checks, but haven't done one, return False
-    if not self._data.has_key('download_check'):
+    if 'download_check' not in self._data:
       return False
     return self._data['download_check']
 
   # output an optional header comment and info for this fallback
   # try_fallback_download_consensus before calling this
-  def fallbackdir_line(self, fallbacks, prefilter_fallbacks):
+  # fb_contact_counts and prefilter_contact_counts are Counters of the
+  # contacts in the final and pre-filter fallback lists
+  def fallbackdir_line(self, fb_contact_counts, prefilter_contact_counts):
     s = ''
     if OUTPUT_COMMENTS:
-      s += self.fallbackdir_comment(fallbacks, prefilter_fallbacks)
+      s += self.fallbackdir_comment(fb_contact_counts,
+                                    prefilter_contact_counts)
     # if the download speed is ok, output a C string
     # if it's not, but we OUTPUT_COMMENTS, output a commented-out C string
     if self.get_fallback_download_consensus() or OUTPUT_COMMENTS:
@@ -1147,7 +1268,7 @@ class Candidate(object):
     return s
 
   # output a header comment for this fallback
-  def fallbackdir_comment(self, fallbacks, prefilter_fallbacks):
+  def fallbackdir_comment(self, fb_contact_counts, prefilter_contact_counts):
     # /*
     # nickname
     # flags
@@ -1155,34 +1276,28 @@ class Candidate(object):
     # [identical contact counts]
     # */
     # Multiline C comment
-    s = '/*'
-    s += '\n'
-    s += cleanse_c_multiline_comment(self._data['nickname'])
-    s += '\n'
-    s += 'Flags: '
-    s += cleanse_c_multiline_comment(' '.join(sorted(self._data['flags'])))
-    s += '\n'
-    if self._data['contact'] is not None:
-      s += cleanse_c_multiline_comment(self._data['contact'])
+    # each fallback's line is output once, so we cleanse its fields here,
+    # rather than caching them for every relay in Candidate.__init__
+    parts = ['/*\n',
+             cleanse_c_multiline_comment(self._data['nickname']),
+             '\nFlags: ',
+             cleanse_c_multiline_comment(' '.join(sorted(self._data['flags']))),
+             '\n']
+    contact = self._data['contact']
+    if contact is not None:
+      parts.append(cleanse_c_multiline_comment(contact))
       if CONTACT_COUNT or CONTACT_BLACKLIST_COUNT:
-        fallback_count = len([f for f in fallbacks
-                              if f._data['contact'] == self._data['contact']])
+        fallback_count = fb_contact_counts[contact]
         if fallback_count > 1:
-          s += '\n'
-          s += '%d identical contacts listed' % (fallback_count)
+          parts.append('\n%d identical contacts listed' % (fallback_count))
       if CONTACT_BLACKLIST_COUNT:
-        prefilter_count = len([f for f in prefilter_fallbacks
-                               if f._data['contact'] == self._data['contact']])
-        filter_count = prefilter_count - fallback_count
+        filter_count = prefilter_contact_counts[contact] - fallback_count
         if filter_count > 0:
-          if fallback_count > 1:
-            s += ' '
-          else:
-            s += '\n'
-          s += '%d blacklisted' % (filter_count)
-      s += '\n'
-    s += '*/'
-    s += '\n'
+          parts.append(' ' if fallback_count > 1 else '\n')
+          parts.append('%d blacklisted' % (filter_count))
+      parts.append('\n')
+    parts.append('*/\n')
+    return ''.join(parts)
 
   # output the fallback info C string for this fallback
   # this is the text that would go after FallbackDir in a torrc
@@ -1199,27 +1314,25 @@ class Candidate(object):
     # If we don't want either kind of string, bail
     if not c_string and not comment_string:
       return ''
-    s = ''
+    parts = []
     # Comment out the fallback directory entry if it's too slow
     # See the debug output for which address and port is failing
     if comment_string:
-      s += '/* Consensus download failed or was too slow:\n'
+      parts.append('/* Consensus download failed or was too slow:\n')
     # Multi-Line C string with trailing comma (part of a string list)
     # This makes it easier to diff the file, and remove IPv6 lines using grep
     # Integers don't need escaping
-    s += '"%s orport=%d id=%s"'%(
-            cleanse_c_string(self._data['dir_address']),
-            self.orport,
-            cleanse_c_string(self._fpr))
-    s += '\n'
-    if self.has_ipv6():
-      s += '" ipv6=%s:%d"'%(cleanse_c_string(self.ipv6addr), self.ipv6orport)
-      s += '\n'
-    s += '" weight=%d",'%(FALLBACK_OUTPUT_WEIGHT)
+    parts.append('"%s orport=%d id=%s"\n'%(
+                   cleanse_c_string(self._data['dir_address']),
+                   self.orport,
+                   cleanse_c_string(self._fpr)))
+    if self._has_ipv6:
+      parts.append('" ipv6=%s:%d"\n'%(cleanse_c_string(self.ipv6addr),
+                                       self.ipv6orport))
+    parts.append('" weight=%d",'%(FALLBACK_OUTPUT_WEIGHT))
     if comment_string:
-      s += '\n'
-      s += '*/'
-    return s
+      parts.append('\n*/')
+    return ''.join(parts)
 
 ## Fallback Candidate List Class
 
@@ -1227,8 +1340,8 @@ class CandidateList(dict):
   def __init__(self):
     pass
 
+  # relays without a dir_address are filtered out by _add_details
   def _add_relay(self, details):
-    if not 'dir_address' in details: return
     c = Candidate(details)
     self[ c.get_fingerprint() ] = c
 
@@ -1241,7 +1354,7 @@ class CandidateList(dict):
     try:
       c = self[fpr]
     except KeyError:
-      logging.debug('Got unknown relay %s in uptime document.'%(fpr,))
+      logging.debug('Got unknown relay %s in uptime document.', fpr)
       return
 
     c.add_uptime(uptime)
@@ -1256,7 +1369,11 @@ class CandidateList(dict):
 
     if not 'relays' in d: raise Exception("No relays found in document.")
 
-    for r in d['relays']: self._add_relay(r)
+    # relays without a DirPort can't be fallbacks
+    # drop them, and the rest of the document, before we create candidates
+    relays = [r for r in d['relays'] if 'dir_address' in r]
+    del d
+    for r in relays: self._add_relay(r)
 
   def _add_uptimes(self):
     logging.debug('Loading uptime document.')
@@ -1264,7 +1381,12 @@ class CandidateList(dict):
     logging.debug('Loading uptime document done.')
 
     if not 'relays' in d: raise Exception("No relays found in document.")
-    for r in d['relays']: self._add_uptime(r)
+    # the uptime document is large, and we only keep the averages, so
+    # drop each relay's history as soon as we've added it
+    relays = d['relays']
+    del d
+    relays.reverse()
+    while relays: self._add_uptime(relays.pop())
 
   def add_relays(self):
     self._add_details()
@@ -1280,9 +1402,7 @@ class CandidateList(dict):
   # Find fallbacks that fit the uptime, stability, and flags criteria,
   # and make an array of them in self.fallbacks
   def compute_fallbacks(self):
-    self.fallbacks = map(lambda x: self[x],
-                         filter(lambda x: self[x].is_candidate(),
-                                self.keys()))
+    self.fallbacks = [c for c in self.itervalues() if c.is_candidate()]
 
   # sort fallbacks by their consensus weight to advertised bandwidth factor,
   # lowest to highest
@@ -1323,19 +1443,13 @@ class CandidateList(dict):
     if file_data is None:
       return relaylist
     for line in file_data.split('\n'):
-      relay_entry = {}
-      # ignore comments
-      line_comment_split = line.split('#')
-      line = line_comment_split[0]
-      # cleanup whitespace
-      line = cleanse_whitespace(line)
-      line = line.strip()
-      if len(line) == 0:
+      # ignore comments, and split the rest of the line on any whitespace
+      # (str.split() skips empty items, so blank lines have no items)
+      items = line.split('#', 1)[0].split()
+      if len(items) == 0:
         continue
-      for item in line.split(' '):
-        item = item.strip()
-        if len(item) == 0:
-          continue
+      relay_entry = {}
+      for item in items:
         key_value_split = item.split('=')
         kvl = len(key_value_split)
         if kvl < 1 or kvl > 2:
@@ -1359,19 +1473,45 @@ class CandidateList(dict):
       relaylist.append(relay_entry)
     return relaylist
 
+  # index the entries in relaylist by their id, ipv4, and ipv6 values
+  # returns a dictionary containing a dictionary for each key,
+  # which maps each value to a list of the entries with that value
+  # (entries without the key are not in that key's dictionary)
+  # this lets each fallback look up its matching entries, rather than
+  # comparing itself to every entry
+  # 'any' is the set of every indexed value, so fallbacks that don't match
+  # any entry can be rejected with a few set lookups
+  @staticmethod
+  def index_relaylist(relaylist):
+    index_keys = ['id', 'ipv4', 'ipv6']
+    relaylist_index = dict((key, {}) for key in index_keys)
+    any_values = set()
+    for entry in relaylist:
+      for key in index_keys:
+        if key in entry:
+          value = entry[key]
+          relaylist_index[key].setdefault(value, []).append(entry)
+          any_values.add(value)
+    relaylist_index['any'] = frozenset(any_values)
+    return relaylist_index
+
   # apply the fallback whitelist and blacklist
   def apply_filter_lists(self):
     excluded_count = 0
     logging.debug('Applying whitelist and blacklist.')
-    # parse the whitelist and blacklist
-    whitelist = self.load_relaylist(WHITELIST_FILE_NAME)
-    blacklist = self.load_relaylist(BLACKLIST_FILE_NAME)
+    # parse and index the whitelist and blacklist
+    whitelist = self.index_relaylist(
+                                   self.load_relaylist(WHITELIST_FILE_NAME))
+    blacklist = self.index_relaylist(
+                                   self.load_relaylist(BLACKLIST_FILE_NAME))
+    blacklist_excludes_whitelist_entries = BLACKLIST_EXCLUDES_WHITELIST_ENTRIES
+    include_unlisted_entries = INCLUDE_UNLISTED_ENTRIES
     filtered_fallbacks = []
     for f in self.fallbacks:
       in_whitelist = f.is_in_whitelist(whitelist)
       in_blacklist = f.is_in_blacklist(blacklist)
       if in_whitelist and in_blacklist:
-        if BLACKLIST_EXCLUDES_WHITELIST_ENTRIES:
+        if blacklist_excludes_whitelist_entries:
           # exclude
           excluded_count += 1
           logging.warning('Excluding %s: in both blacklist and whitelist.',
@@ -1387,7 +1527,7 @@ class CandidateList(dict):
         excluded_count += 1
         logging.info('Excluding %s: in blacklist.', f._fpr)
       else:
-        if INCLUDE_UNLISTED_ENTRIES:
+        if include_unlisted_entries:
           # include
           filtered_fallbacks.append(f)
         else:
@@ -1421,18 +1561,21 @@ class CandidateList(dict):
   def remove_low_bandwidth_relays(self):
     if MIN_BANDWIDTH is None:
       return
-    above_min_bw_fallbacks = []
-    for f in self.fallbacks:
-      if f._data['measured_bandwidth'] >= MIN_BANDWIDTH:
-        above_min_bw_fallbacks.append(f)
-      else:
-        # the bandwidth we log here is limited by the relay's consensus weight
-        # as well as its adverttised bandwidth. See set_measured_bandwidth
-        # for details
-        logging.info('%s not a candidate: bandwidth %.1fMB/s too low, must ' +
-                     'be at least %.1fMB/s', f._fpr,
-                     f._data['measured_bandwidth']/(1024.0*1024.0),
-                     MIN_BANDWIDTH/(1024.0*1024.0))
+    min_bandwidth = MIN_BANDWIDTH
+    above_min_bw_fallbacks = [f for f in self.fallbacks
+                              if f._data['measured_bandwidth'] >= min_bandwidth]
+    # only look for the removed relays if we're going to log them
+    if (len(above_min_bw_fallbacks) < len(self.fallbacks)
+        and logging.getLogger().isEnabledFor(logging.INFO)):
+      for f in self.fallbacks:
+        if f._data['measured_bandwidth'] < min_bandwidth:
+          # the bandwidth we log here is limited by the relay's consensus
+          # weight as well as its adverttised bandwidth.
+          # See set_measured_bandwidth for details
+          logging.info('%s not a candidate: bandwidth %.1fMB/s too low, ' +
+                       'must be at least %.1fMB/s', f._fpr,
+                       f._data['measured_bandwidth']/(1024.0*1024.0),
+                       min_bandwidth/(1024.0*1024.0))
     self.fallbacks = above_min_bw_fallbacks
 
   # the minimum fallback in the list
@@ -1503,11 +1646,11 @@ class CandidateList(dict):
         if f.has_ipv6():
           ip_list.append(f.ipv6addr)
       elif not CandidateList.allow(f.dirip, ip_list):
-        logging.info('Eliminated %s: already have fallback on IPv4 %s'%(
-                                                          f._fpr, f.dirip))
+        logging.info('Eliminated %s: already have fallback on IPv4 %s',
+                     f._fpr, f.dirip)
       elif f.has_ipv6() and not CandidateList.allow(f.ipv6addr, ip_list):
-        logging.info('Eliminated %s: already have fallback on IPv6 %s'%(
-                                                          f._fpr, f.ipv6addr))
+        logging.info('Eliminated %s: already have fallback on IPv6 %s',
+                     f._fpr, f.ipv6addr)
     original_count = len(self.fallbacks)
     self.fallbacks = ip_limit_fallbacks
     return original_count - len(self.fallbacks)
@@ -1526,8 +1669,8 @@ class CandidateList(dict):
         contact_limit_fallbacks.append(f)
         contact_list.append(f._data['contact'])
       else:
-        logging.info(('Eliminated %s: already have fallback on ' +
-                       'ContactInfo %s')%(f._fpr, f._data['contact']))
+        logging.info('Eliminated %s: already have fallback on ' +
+                     'ContactInfo %s', f._fpr, f._data['contact'])
     original_count = len(self.fallbacks)
     self.fallbacks = contact_limit_fallbacks
     return original_count - len(self.fallbacks)
@@ -1550,7 +1693,7 @@ class CandidateList(dict):
         # technically, we already have a fallback with this fallback in its
         # effective family
         logging.info('Eliminated %s: already have fallback in effective ' +
-                      'family'%(f._fpr))
+                     'family', f._fpr)
     original_count = len(self.fallbacks)
     self.fallbacks = family_limit_fallbacks
     return original_count - len(self.fallbacks)
@@ -1558,16 +1701,51 @@ class CandidateList(dict):
   # try a download check on each fallback candidate in order
   # stop after max_count successful downloads
   # but don't remove any candidates from the array
+  # the checks are run in batches of up to CONSENSUS_DOWNLOAD_THREADS
+  # each batch assumes its checks will all succeed, so we never check a
+  # fallback that checking in turn would have skipped
   def try_download_consensus_checks(self, max_count):
     dl_ok_count = 0
-    for f in self.fallbacks:
-      f.try_fallback_download_consensus()
-      if f.get_fallback_download_consensus():
-        # this fallback downloaded a consensus ok
-        dl_ok_count += 1
-        if dl_ok_count >= max_count:
-          # we have enough fallbacks
-          return
+    if CONSENSUS_DOWNLOAD_THREADS <= 1:
+      for f in self.fallbacks:
+        f.try_fallback_download_consensus()
+        if f.get_fallback_download_consensus():
+          # this fallback downloaded a consensus ok
+          dl_ok_count += 1
+          if dl_ok_count >= max_count:
+            # we have enough fallbacks
+            return
+      return
+    position = 0
+    pool = ThreadPool(CONSENSUS_DOWNLOAD_THREADS)
+    try:
+      while position < len(self.fallbacks) and dl_ok_count < max_count:
+        batch = []
+        while (position < len(self.fallbacks)
+               and dl_ok_count + len(batch) < max_count
+               and len(batch) < CONSENSUS_DOWNLOAD_THREADS):
+          f = self.fallbacks[position]
+          position += 1
+          if f.get_fallback_download_consensus():
+            # this fallback has already downloaded a consensus ok
+            dl_ok_count += 1
+          else:
+            batch.append(f)
+        # on python 2, waiting without a timeout ignores Ctrl-C until the
+        # whole batch finishes, so wait (practically) forever instead
+        # each download has its own timeout
+        pool.map_async(Candidate.try_fallback_download_consensus,
+                       batch).get(sys.maxint)
+        for f in batch:
+          if f.get_fallback_download_consensus():
+            # this fallback downloaded a consensus ok
+            dl_ok_count += 1
+    except BaseException:
+      # don't wait for the running downloads, so that Ctrl-C exits promptly
+      pool.terminate()
+      raise
+    pool.close()
+    pool.join()
 
   # put max_count successful candidates in the fallbacks array:
   # - perform download checks on each fallback candidate
@@ -1659,7 +1837,7 @@ class CandidateList(dict):
         if (most_frequent_netblock is None
             or len(netblocks[b]) > len(netblocks[most_frequent_netblock])):
           most_frequent_netblock = b
-        logging.debug('Fallback IPv4 addresses in the same /%d:'%(mask_bits))
+        logging.debug('Fallback IPv4 addresses in the same /%d:', mask_bits)
         for f in netblocks[b]:
           logging.debug('%s - %s', f.dirip, f._fpr)
     if most_frequent_netblock is not None:
@@ -1691,7 +1869,7 @@ class CandidateList(dict):
         if (most_frequent_netblock is None
             or len(netblocks[b]) > len(netblocks[most_frequent_netblock])):
           most_frequent_netblock = b
-        logging.debug('Fallback IPv6 addresses in the same /%d:'%(mask_bits))
+        logging.debug('Fallback IPv6 addresses in the same /%d:', mask_bits)
         for f in netblocks[b]:
           logging.debug('%s - %s', f.ipv6addr, f._fpr)
     if most_frequent_netblock is not None:
@@ -1914,7 +2092,10 @@ def list_fallbacks():
     max_count = min(target_count, MAX_FALLBACK_COUNT)
 
   candidates.compute_fallbacks()
-  prefilter_fallbacks = copy.copy(candidates.fallbacks)
+  # count the contacts before filtering, so we can report how many fallbacks
+  # with each contact were filtered out
+  prefilter_contact_counts = Counter(f._data['contact']
+                                     for f in candidates.fallbacks)
 
   # filter with the whitelist and blacklist
   # if a relay has changed IPv4 address or ports recently, it will be excluded
@@ -1987,8 +2168,10 @@ def list_fallbacks():
   if not OUTPUT_CANDIDATES:
     candidates.sort_fallbacks_by_fingerprint()
 
+  # count the fallbacks with each contact once, rather than once per fallback
+  fb_contact_counts = Counter(f._data['contact'] for f in candidates.fallbacks)
   for x in candidates.fallbacks:
-    print x.fallbackdir_line(candidates.fallbacks, prefilter_fallbacks)
+    print x.fallbackdir_line(fb_contact_counts, prefilter_contact_counts)
 
 if __name__ == "__main__":
   list_fallbacks()